@@ -17,163 +17,437 @@
    Cliente → "EXTRACT 1-5\n" | 8 bytes | PDF.
    → Se o PDF possuir páginas ≥ end, extrai intervalo [start,end],
      salva e devolve UUID; caso contrário, responde "PAGEERR\n".
+
+UPLOAD, MERGE e EXTRACT com as mesmas entradas (mesmo SHA-256) devolvem o
+UUID do resultado já salvo, sem gravar nem processar o PDF de novo.
+
+A conexão é persistente: o cliente pode enviar vários comandos em sequência
+na mesma conexão; ela é encerrada após IDLE_TIMEOUT sem atividade.
+
+Com o pool de atendimento saturado, o servidor responde "BUSY\n" e fecha
+a conexão sem ler o comando.
 """
 
 from __future__ import annotations
 
+import hashlib
 import io
+import multiprocessing
+import os
 import re
 import socket
 import struct
 import threading
 import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Tuple
+from typing import Callable, Dict, Iterator, Optional, Set, Tuple
 
 try:
-    from PyPDF2 import PdfReader, PdfWriter
+    import pikepdf
 except ImportError as exc:
-    raise SystemExit("PyPDF2 não instalado. Execute: pip install PyPDF2") from exc
+    raise SystemExit("pikepdf não instalado. Execute: pip install pikepdf") from exc
 
 HOST = "0.0.0.0"
 PORT = 9000
 STORAGE_DIR = Path("pdf_storage")
 BUFFER_SIZE = 1 << 20  # 1 MiB
+READ_BUFFER_SIZE = 1 << 16  # 64 KiB (buffer do makefile)
+# buffers de socket do kernel; None mantém o autotuning do TCP (tcp_rmem /
+# tcp_wmem), que já cresce até o BDP do link. Definir um valor fixa o buffer
+# e DESATIVA o autotuning: só use com o BDP medido, lembrando que o Linux o
+# limita a net.core.rmem_max / wmem_max (ex.: 4 << 20 e 16 << 20)
+SOCKET_RCVBUF: Optional[int] = None
+SOCKET_SNDBUF: Optional[int] = None
+# conexões persistentes ocupam uma thread mesmo ociosas, então o pool é
+# dimensionado pelo número de conexões, não só pelo de CPUs
+MAX_WORKERS = max(32, (os.cpu_count() or 1) * 2)
+MAX_QUEUED = MAX_WORKERS * 4  # acima disso o servidor responde "BUSY\n"
+IDLE_TIMEOUT = 60  # s sem atividade até fechar uma conexão persistente
+NUM_PROCESSES = os.cpu_count() or 1  # processos de atendimento (SO_REUSEPORT)
+
+CACHE_ENTRIES = 4096  # resultados lembrados pelo cache de deduplicação
+SIZE_INDEX_ENTRIES = 16384  # tamanhos de PDFs salvos lembrados para o DOWNLOAD
+RAND_BLOCK_SIZE = 4096  # bytes de os.urandom por recarga do buffer de UUIDs
+
+EXTRACT_RE = re.compile(rb"EXTRACT\s+(\d+)-(\d+)$")
+UUID_RE = re.compile(rb"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}")
 
 STORAGE_DIR.mkdir(exist_ok=True)
 
+# tamanho dos PDFs salvos por este processo (arquivos nunca mudam depois de
+# salvos); poupa o stat() no DOWNLOAD. LRU limitado: quem sai cai no fstat()
+_file_sizes: "OrderedDict[str, int]" = OrderedDict()
+_file_sizes_lock = threading.Lock()
+
+# bytes aleatórios lidos em bloco: um getrandom() a cada 256 UUIDs, não a cada um
+_rand_buf = bytearray()
+_rand_lock = threading.Lock()
+# um processo filho não pode reaproveitar os bytes já sorteados pelo pai
+os.register_at_fork(after_in_child=_rand_buf.clear)
+
+# encerramento: handle_client para entre comandos e _stop fecha as conexões abertas
+_shutdown = threading.Event()
+_open_conns: Set[socket.socket] = set()
+_open_conns_lock = threading.Lock()
+
+# resultados já salvos, por SHA-256 da operação + entradas (LRU, por processo)
+_cache: "OrderedDict[bytes, str]" = OrderedDict()
+_cache_lock = threading.Lock()
+
 # ---------------- utils ----------------
 
-def _read_line(conn: socket.socket) -> str:
-    buf = bytearray()
-    while not buf.endswith(b"\n"):
-        chunk = conn.recv(1)
-        if not chunk:
-            break
-        buf.extend(chunk)
-    return buf.decode().strip()
-
-def _recv_exact(conn: socket.socket, size: int) -> bytes:
-    buf = bytearray()
-    while len(buf) < size:
-        chunk = conn.recv(min(BUFFER_SIZE, size - len(buf)))
-        if not chunk:
+def _new_uuid() -> str:
+    with _rand_lock:
+        if len(_rand_buf) < 16:
+            _rand_buf.extend(os.urandom(RAND_BLOCK_SIZE))
+        raw = bytes(_rand_buf[-16:])
+        del _rand_buf[-16:]
+    return str(uuid.UUID(bytes=raw, version=4))
+
+def _read_line(rfile: io.BufferedReader) -> bytes:
+    return rfile.readline().strip()
+
+def _recv_exact(rfile: io.BufferedReader, size: int) -> bytearray:
+    # só para cabeçalhos de tamanho fixo: o buffer tem o tamanho pedido já de
+    # início, então payloads (tamanho vindo do cliente) passam por _spooled_pdf
+    buf = bytearray(size)
+    view = memoryview(buf)
+    off = 0
+    while off < size:
+        n = rfile.readinto(view[off:off + BUFFER_SIZE])
+        if not n:
             raise ValueError("Conexão encerrada prematuramente")
-        buf.extend(chunk)
-    return bytes(buf)
+        off += n
+    return buf
+
+@contextmanager
+def _spooled_pdf(rfile: io.BufferedReader) -> Iterator[Tuple[Path, bytes]]:
+    """Recebe tamanho + PDF direto em um arquivo temporário, removido ao sair.
+
+    O PDF não passa inteiro pela memória do processo: o pikepdf lê o arquivo
+    sob demanda e as páginas ficam no page cache do kernel. Junto com o
+    caminho vem o SHA-256 do conteúdo, calculado enquanto ele chega.
+    """
+    size = struct.unpack("!Q", _recv_exact(rfile, 8))[0]
+    path = STORAGE_DIR / f"{_new_uuid()}.in"
+    try:
+        with path.open("wb") as fp:
+            # um único bloco reaproveitado em todo o payload: nenhum bytes por recv
+            view = memoryview(bytearray(min(BUFFER_SIZE, size)))
+            digest = hashlib.sha256()
+            remaining = size
+            while remaining:
+                n = rfile.readinto(view[:min(len(view), remaining)])
+                if not n:
+                    raise ValueError("Conexão encerrada prematuramente")
+                fp.write(view[:n])
+                digest.update(view[:n])
+                remaining -= n
+        yield path, digest.digest()
+    finally:
+        path.unlink(missing_ok=True)
+
+@contextmanager
+def _corked(conn: socket.socket):
+    """Segura segmentos parciais (TCP_CORK) para que o cabeçalho saia junto com o início do arquivo."""
+    if not hasattr(socket, "TCP_CORK"):  # apenas Linux
+        yield
+        return
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+    try:
+        yield
+    finally:
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
+
+def _write_file(path: Path, data: bytes | bytearray):
+    # grava em <path>.tmp e renomeia: um DOWNLOAD concorrente nunca vê o arquivo pela metade
+    tmp = path.with_name(path.name + ".tmp")
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        try:
+            if data and hasattr(os, "posix_fallocate"):
+                os.posix_fallocate(fd, 0, len(data))  # reserva as extents de uma vez
+            view = memoryview(data)
+            while view:
+                view = view[os.writev(fd, [view]):]
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(tmp, path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
 
-def _save_pdf(data: bytes) -> str:
-    file_uuid = str(uuid.uuid4())
-    (STORAGE_DIR / f"{file_uuid}.pdf").write_bytes(data)
+def _save_pdf(data: bytes | bytearray) -> str:
+    file_uuid = _new_uuid()
+    _write_file(STORAGE_DIR / f"{file_uuid}.pdf", data)
+    _size_put(file_uuid, len(data))
     return file_uuid
 
+def _save_spooled(path: Path) -> str:
+    # o arquivo recebido vira o PDF salvo por rename, sem nova cópia dos dados
+    file_uuid = _new_uuid()
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        size = os.fstat(fd).st_size
+    finally:
+        os.close(fd)
+    os.replace(path, STORAGE_DIR / f"{file_uuid}.pdf")
+    _size_put(file_uuid, size)
+    return file_uuid
+
+def _size_get(uuid_str: str) -> int | None:
+    with _file_sizes_lock:
+        size = _file_sizes.get(uuid_str)
+        if size is not None:
+            _file_sizes.move_to_end(uuid_str)
+        return size
+
+def _size_put(uuid_str: str, size: int):
+    with _file_sizes_lock:
+        _file_sizes[uuid_str] = size
+        if len(_file_sizes) > SIZE_INDEX_ENTRIES:
+            _file_sizes.popitem(last=False)
+
+def _cache_get(key: bytes) -> str | None:
+    with _cache_lock:
+        uuid_str = _cache.get(key)
+        if uuid_str is None:
+            return None
+        if not (STORAGE_DIR / f"{uuid_str}.pdf").exists():  # removido do disco
+            del _cache[key]
+            return None
+        _cache.move_to_end(key)
+        return uuid_str
+
+def _cache_put(key: bytes, uuid_str: str):
+    with _cache_lock:
+        _cache[key] = uuid_str
+        _cache.move_to_end(key)
+        if len(_cache) > CACHE_ENTRIES:
+            _cache.popitem(last=False)  # só esquece a entrada; o arquivo continua salvo
+
+def _cached(key: bytes, save: Callable[[], str]) -> Tuple[str, bool]:
+    """UUID de um resultado já salvo para ``key`` ou, se não houver, o de ``save()``.
+
+    Devolve (uuid, veio_do_cache).
+    """
+    uuid_str = _cache_get(key)
+    if uuid_str is not None:
+        return uuid_str, True
+    uuid_str = save()
+    _cache_put(key, uuid_str)
+    return uuid_str, False
+
 # ---------------- operações de PDF ----------------
 
-def _merge_pdfs(data_a: bytes, data_b: bytes) -> bytes:
-    reader_a, reader_b = PdfReader(io.BytesIO(data_a)), PdfReader(io.BytesIO(data_b))
-    writer = PdfWriter()
-    for p in reader_a.pages:
-        writer.add_page(p)
-    for p in reader_b.pages:
-        writer.add_page(p)
+def _save_to_bytes(pdf: pikepdf.Pdf) -> bytes:
     out = io.BytesIO()
-    writer.write(out)
+    pdf.save(out)
     return out.getvalue()
 
-def _extract_range(data: bytes, start: int, end: int) -> bytes:
-    reader = PdfReader(io.BytesIO(data))
-    if len(reader.pages) < end:
-        raise ValueError("NOT_ENOUGH_PAGES")
-    writer = PdfWriter()
-    for idx in range(start - 1, end):  # 0‑based
-        writer.add_page(reader.pages[idx])
-    out = io.BytesIO()
-    writer.write(out)
-    return out.getvalue()
+def _merge_pdfs(path_a: Path, path_b: Path) -> bytes:
+    with pikepdf.Pdf.open(path_a) as pdf_a, \
+         pikepdf.Pdf.open(path_b) as pdf_b, \
+         pikepdf.Pdf.new() as dst:
+        dst.pages.extend(pdf_a.pages)
+        dst.pages.extend(pdf_b.pages)
+        return _save_to_bytes(dst)
+
+def _extract_range(path: Path, start: int, end: int) -> bytes:
+    with pikepdf.Pdf.open(path) as src:
+        if len(src.pages) < end:
+            raise ValueError("NOT_ENOUGH_PAGES")
+        with pikepdf.Pdf.new() as dst:
+            dst.pages.extend(src.pages[start - 1:end])  # 0‑based
+            return _save_to_bytes(dst)
 
 # ---------------- handler ----------------
 
-def handle_client(conn: socket.socket, addr: Tuple[str, int]):
+Handler = Callable[[socket.socket, io.BufferedReader, Tuple[str, int], bytes], bool]
+
+# cada handler recebe a linha de comando inteira e devolve False se a
+# conexão não pode ser reaproveitada
+
+def _handle_upload(conn: socket.socket, rfile: io.BufferedReader,
+                   addr: Tuple[str, int], cmd_line: bytes) -> bool:
+    with _spooled_pdf(rfile) as (path, digest):
+        size = path.stat().st_size
+        uuid_str, hit = _cached(digest, lambda: _save_spooled(path))
+    conn.sendall(f"{uuid_str}\n".encode())
+    print(f"[UPLOAD] {addr} -> {uuid_str} ({size} bytes){' (cache)' if hit else ''}")
+    return True
+
+def _handle_download(conn: socket.socket, rfile: io.BufferedReader,
+                     addr: Tuple[str, int], cmd_line: bytes) -> bool:
+    # só um UUID canônico: qualquer outra coisa pode ser um comando injetado,
+    # então a conexão é encerrada
+    parts = cmd_line.split()
+    if len(parts) != 2 or not UUID_RE.fullmatch(parts[1]):
+        conn.sendall(b"BADREQUEST\n"); return False
+    uuid_str = parts[1].decode()
     try:
-        cmd_line = _read_line(conn)
-        if not cmd_line:
-            return
-
-        # ---- UPLOAD ----
-        if cmd_line == "UPLOAD":
-            size = struct.unpack("!Q", _recv_exact(conn, 8))[0]
-            data = _recv_exact(conn, size)
-            uuid_str = _save_pdf(data)
-            conn.sendall(f"{uuid_str}\n".encode())
-            print(f"[UPLOAD] {addr} -> {uuid_str} ({size} bytes)")
-            return
-
-        # ---- DOWNLOAD ----
-        if cmd_line.startswith("DOWNLOAD"):
-            parts = cmd_line.split()
-            if len(parts) != 2:
-                conn.sendall(b"BADREQUEST\n"); return
-            uuid_str = parts[1]
-            path = STORAGE_DIR / f"{uuid_str}.pdf"
-            if not path.exists():
-                conn.sendall(b"NOTFOUND\n"); return
-            size = path.stat().st_size
-            conn.sendall(b"FOUND\n" + struct.pack("!Q", size))
-            with path.open("rb") as fp:
-                while chunk := fp.read(BUFFER_SIZE):
-                    conn.sendall(chunk)
-            print(f"[DOWNLOAD] {addr} <- {uuid_str} ({size} bytes)")
-            return
-
-        # ---- MERGE ----
-        if cmd_line == "MERGE":
-            size_a = struct.unpack("!Q", _recv_exact(conn, 8))[0]
-            data_a = _recv_exact(conn, size_a)
-            size_b = struct.unpack("!Q", _recv_exact(conn, 8))[0]
-            data_b = _recv_exact(conn, size_b)
-            merged = _merge_pdfs(data_a, data_b)
-            uuid_str = _save_pdf(merged)
-            conn.sendall(f"{uuid_str}\n".encode())
-            print(f"[MERGE] {addr} -> {uuid_str}")
-            return
-
-        # ---- EXTRACT ----
-        if cmd_line.startswith("EXTRACT"):
-            m = re.match(r"EXTRACT\s+(\d+)-(\d+)$", cmd_line)
-            if not m:
-                conn.sendall(b"BADREQUEST\n"); return
-            start, end = map(int, m.groups())
-            if start < 1 or end < start:
-                conn.sendall(b"BADREQUEST\n"); return
-            size = struct.unpack("!Q", _recv_exact(conn, 8))[0]
-            data = _recv_exact(conn, size)
-            try:
-                extracted = _extract_range(data, start, end)
-            except ValueError:
-                conn.sendall(b"PAGEERR\n"); return
-            uuid_str = _save_pdf(extracted)
-            conn.sendall(f"{uuid_str}\n".encode())
-            print(f"[EXTRACT] {addr} -> {uuid_str} ({start}-{end})")
-            return
-
-        # ---- desconhecido ----
+        fp = (STORAGE_DIR / f"{uuid_str}.pdf").open("rb")
+    except FileNotFoundError:
+        conn.sendall(b"NOTFOUND\n"); return True
+    with fp, _corked(conn):
+        size = _size_get(uuid_str)
+        if size is None:  # salvo por outro processo, antes deste iniciar ou já esquecido
+            size = os.fstat(fp.fileno()).st_size
+        conn.sendall(b"FOUND\n" + struct.pack("!Q", size))
+        conn.sendfile(fp, 0, size)  # sendfile(2): page cache → socket, sem cópia em userspace
+    print(f"[DOWNLOAD] {addr} <- {uuid_str} ({size} bytes)")
+    return True
+
+def _handle_merge(conn: socket.socket, rfile: io.BufferedReader,
+                  addr: Tuple[str, int], cmd_line: bytes) -> bool:
+    with _spooled_pdf(rfile) as (path_a, digest_a), _spooled_pdf(rfile) as (path_b, digest_b):
+        key = hashlib.sha256(b"M" + digest_a + digest_b).digest()
+        uuid_str, hit = _cached(key, lambda: _save_pdf(_merge_pdfs(path_a, path_b)))
+    conn.sendall(f"{uuid_str}\n".encode())
+    print(f"[MERGE] {addr} -> {uuid_str}{' (cache)' if hit else ''}")
+    return True
+
+def _handle_extract(conn: socket.socket, rfile: io.BufferedReader,
+                    addr: Tuple[str, int], cmd_line: bytes) -> bool:
+    # BADREQUEST aqui deixa o payload sem ler: a conexão é encerrada
+    m = EXTRACT_RE.match(cmd_line)
+    if not m:
+        conn.sendall(b"BADREQUEST\n"); return False
+    start, end = map(int, m.groups())
+    if start < 1 or end < start:
+        conn.sendall(b"BADREQUEST\n"); return False
+    with _spooled_pdf(rfile) as (path, digest):
+        key = hashlib.sha256(b"E%d-%d" % (start, end) + digest).digest()
+        try:
+            uuid_str, hit = _cached(key, lambda: _save_pdf(_extract_range(path, start, end)))
+        except ValueError:
+            conn.sendall(b"PAGEERR\n"); return True
+    conn.sendall(f"{uuid_str}\n".encode())
+    print(f"[EXTRACT] {addr} -> {uuid_str} ({start}-{end}){' (cache)' if hit else ''}")
+    return True
+
+HANDLERS: Dict[bytes, Handler] = {
+    b"UPLOAD": _handle_upload,
+    b"DOWNLOAD": _handle_download,
+    b"MERGE": _handle_merge,
+    b"EXTRACT": _handle_extract,
+}
+
+def _handle_command(conn: socket.socket, rfile: io.BufferedReader,
+                    addr: Tuple[str, int], cmd_line: bytes) -> bool:
+    """Atende um comando; devolve False se a conexão não pode ser reaproveitada."""
+    handler = HANDLERS.get(cmd_line.split(None, 1)[0])
+    if handler is None:
         conn.sendall(b"UNKNOWN\n")
+        return False
+    return handler(conn, rfile, addr, cmd_line)
+
+def handle_client(conn: socket.socket, addr: Tuple[str, int]):
+    # a conexão é persistente: comandos são atendidos em sequência até EOF
+    # (ou IDLE_TIMEOUT sem atividade)
+    conn.settimeout(IDLE_TIMEOUT)
+    # leitor bufferizado: o cabeçalho sai em um único recv, e os bytes já
+    # lidos além do "\n" ficam disponíveis para _recv_exact
+    rfile = conn.makefile("rb", buffering=READ_BUFFER_SIZE)
+    try:
+        while not _shutdown.is_set():
+            cmd_line = _read_line(rfile)
+            if not cmd_line:
+                return
+            if not _handle_command(conn, rfile, addr, cmd_line):
+                return
+    except TimeoutError:
+        pass
     except Exception as e:
         print(f"[ERROR] {addr}: {e}")
     finally:
+        with _open_conns_lock:
+            _open_conns.discard(conn)
+        rfile.close()
         conn.close()
 
 # ---------------- main ----------------
 
-def start_server(host: str = HOST, port: int = PORT):
+def _reject_busy(conn: socket.socket, addr: Tuple[str, int]):
+    try:
+        conn.sendall(b"BUSY\n")
+    except OSError:
+        pass
+    finally:
+        conn.close()
+    print(f"[BUSY] {addr}")
+
+def _stop(pool: ThreadPoolExecutor):
+    # conexões persistentes mantêm os workers (não-daemon) vivos: sinaliza o
+    # fim, descarta as que ainda esperam na fila e fecha a leitura das ativas,
+    # o que acorda quem está bloqueado esperando o próximo comando
+    _shutdown.set()
+    pool.shutdown(wait=False, cancel_futures=True)
+    with _open_conns_lock:
+        active = list(_open_conns)
+    for conn in active:
+        try:
+            conn.shutdown(socket.SHUT_RD)
+        except OSError:
+            pass
+    pool.shutdown(wait=True)
+    with _open_conns_lock:
+        # sobram só as da fila cancelada: handle_client nunca rodou para elas
+        leftover = list(_open_conns)
+        _open_conns.clear()
+    for conn in leftover:
+        conn.close()
+
+def start_server(host: str = HOST, port: int = PORT, reuse_port: bool = False):
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as srv:
         srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # definidos no socket de escuta para valer já no handshake (a escala
+        # da janela TCP é negociada no SYN); as conexões aceitas os herdam
+        if SOCKET_RCVBUF is not None:
+            srv.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_RCVBUF)
+        if SOCKET_SNDBUF is not None:
+            srv.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_SNDBUF)
+        if reuse_port:
+            # cada processo tem seu próprio socket de escuta; o kernel
+            # distribui as conexões novas entre eles
+            srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         srv.bind((host, port))
         srv.listen()
-        print(f"Servidor escutando em {host}:{port}")
-        while True:
-            conn, addr = srv.accept()
-            threading.Thread(target=handle_client, args=(conn, addr), daemon=True).start()
+        print(f"Servidor escutando em {host}:{port} (pid {os.getpid()})")
+        pool = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="pdfsrv")
+        # limita conexões em andamento (executando + na fila do pool)
+        slots = threading.BoundedSemaphore(MAX_WORKERS + MAX_QUEUED)
+        try:
+            while True:
+                conn, addr = srv.accept()
+                # respostas são linhas curtas: sem Nagle elas não esperam o ACK anterior
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                if not slots.acquire(blocking=False):
+                    _reject_busy(conn, addr)
+                    continue
+                with _open_conns_lock:
+                    _open_conns.add(conn)
+                pool.submit(handle_client, conn, addr).add_done_callback(lambda _: slots.release())
+        finally:
+            _stop(pool)
+
+def start_workers(host: str = HOST, port: int = PORT, workers: int = NUM_PROCESSES):
+    if workers <= 1 or not hasattr(socket, "SO_REUSEPORT"):
+        start_server(host, port)
+        return
+    procs = [
+        multiprocessing.Process(target=start_server, args=(host, port, True))
+        for _ in range(workers)
+    ]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
 
 if __name__ == "__main__":
-    start_server()
+    start_workers()
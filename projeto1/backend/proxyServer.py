@@ -3,7 +3,7 @@ Servidor HTTP intermediário (FastAPI) que se comunica via socket com
 o servidor.
 
 Dependências:
-  pip install fastapi uvicorn python-multipart PyPDF2
+  pip install fastapi uvicorn uvloop httptools python-multipart pikepdf
 
 Endpoints:
   POST /upload      – envia um PDF e devolve uuid
@@ -15,16 +15,35 @@ Endpoints:
 from fastapi import FastAPI, UploadFile, File, HTTPException, Form
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse, JSONResponse
+import asyncio
+import io
+import os
 import socket
 import struct
 import re
-from typing import Generator
+import time
+import uuid
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Generator, Optional, Tuple, Union
 
 SOCKET_HOST = "0.0.0.0"
 SOCKET_PORT = 9000
 BUFFER_SIZE = 1 << 20
+READ_BUFFER_SIZE = 1 << 16
+# buffers de socket do kernel (uploads saem, downloads chegam); None mantém
+# o autotuning do TCP. Um valor fixo DESATIVA o autotuning e é limitado por
+# net.core.wmem_max / rmem_max: só defina com o BDP medido
+SOCKET_SNDBUF: Optional[int] = None
+SOCKET_RCVBUF: Optional[int] = None
+POOL_SIZE = 8  # conexões ociosas mantidas com o servidor de PDFs
+POOL_IDLE_TIMEOUT = 30  # s; menor que o IDLE_TIMEOUT do servidor
 
-app = FastAPI(title="PDF Intermediary Server")
+@asynccontextmanager
+async def _lifespan(app: FastAPI) -> AsyncIterator[None]:
+    yield
+    await _pool.close()
+
+app = FastAPI(title="PDF Intermediary Server", lifespan=_lifespan)
 
 origins = [
     "http://localhost:5173",
@@ -34,34 +53,59 @@ origins = [
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=origins,
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST"],
+    allow_headers=["content-type"],
+    max_age=86400,  # navegador reaproveita o preflight por 24 h
 )
 
 # ---------- helpers de socket ----------
 
-def _send(sock: socket.socket, data: bytes):
-    sock.sendall(data)
-
-def _recv_exact(sock: socket.socket, size: int) -> bytes:
-    buf = bytearray()
-    while len(buf) < size:
-        chunk = sock.recv(min(BUFFER_SIZE, size - len(buf)))
-        if not chunk:
-            raise RuntimeError("Conexão encerrada")
-        buf.extend(chunk)
-    return bytes(buf)
-
-def _recv_line(sock: socket.socket) -> str:
-    buf = bytearray()
-    while not buf.endswith(b"\n"):
-        chunk = sock.recv(1)
-        if not chunk:
-            break
-        buf.extend(chunk)
-    return buf.decode().strip()
+async def _send(writer: asyncio.StreamWriter, data: bytes):
+    writer.write(data)
+    await writer.drain()
+
+async def _file_size(up: UploadFile) -> int:
+    if up.size is not None:
+        return up.size
+    await up.seek(0)
+    up.file.seek(0, io.SEEK_END)
+    size = up.file.tell()
+    await up.seek(0)
+    return size
+
+async def _send_file(writer: asyncio.StreamWriter, up: UploadFile, prefix: bytes = b""):
+    """Envia tamanho + conteúdo do upload em blocos, sem carregar o PDF inteiro na memória.
+
+    ``prefix`` (ex.: a linha de comando) sai no mesmo segmento que o tamanho e o
+    primeiro bloco, em vez de ir sozinho em um pacote pequeno.
+    """
+    size = await _file_size(up)
+    chunk = await up.read(BUFFER_SIZE)
+    writer.writelines((prefix, struct.pack("!Q", size), chunk))
+    await writer.drain()
+    sent = len(chunk)
+    while chunk := await up.read(BUFFER_SIZE):
+        await _send(writer, chunk)
+        sent += len(chunk)
+    if sent != size:
+        raise RuntimeError(f"{up.filename}: tamanho mudou durante o envio")
+
+async def _recv_exact(reader: asyncio.StreamReader, size: int) -> bytes:
+    try:
+        return await reader.readexactly(size)
+    except asyncio.IncompleteReadError as exc:
+        raise RuntimeError("Conexão encerrada") from exc
+
+async def _recv_line(reader: asyncio.StreamReader) -> str:
+    raw = await reader.readline()
+    if not raw.endswith(b"\n"):  # EOF: o servidor fechou a conexão sem responder
+        raise ConnectionError("Conexão encerrada pelo servidor de PDFs")
+    line = raw.decode().strip()
+    if line == "BUSY":
+        raise HTTPException(503, "Servidor de PDFs sobrecarregado, tente novamente")
+    return line
 
 # ---------- validações ----------
 
@@ -80,75 +124,166 @@ def _parse_range(rng: str):
         raise HTTPException(400, "Range inválido")
     return start, end
 
+# ---------- pool de conexões com o servidor de PDFs ----------
+
+Stream = Tuple[asyncio.StreamReader, asyncio.StreamWriter]
+
+class SocketPool:
+    """Conexões persistentes com o servidor de PDFs, reaproveitadas entre requisições."""
+
+    def __init__(self, size: int):
+        self._idle: asyncio.LifoQueue = asyncio.LifoQueue(maxsize=size)
+
+    async def _connect(self) -> Stream:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            # buffers definidos antes do connect para valerem já no handshake
+            if SOCKET_SNDBUF is not None:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_SNDBUF)
+            if SOCKET_RCVBUF is not None:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_RCVBUF)
+            # o asyncio já ativa TCP_NODELAY; explícito para não depender disso
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            sock.setblocking(False)
+            await asyncio.get_running_loop().sock_connect(sock, (SOCKET_HOST, SOCKET_PORT))
+        except BaseException:
+            sock.close()
+            raise
+        return await asyncio.open_connection(sock=sock, limit=READ_BUFFER_SIZE)
+
+    async def _get(self) -> Stream:
+        while True:
+            try:
+                reader, writer, last_used = self._idle.get_nowait()
+            except asyncio.QueueEmpty:
+                return await self._connect()
+            # o servidor fecha conexões ociosas; descarta as que podem já ter expirado
+            if time.monotonic() - last_used < POOL_IDLE_TIMEOUT and not reader.at_eof():
+                return reader, writer
+            writer.close()
+
+    async def close(self):
+        """Fecha as conexões ociosas (encerramento do servidor)."""
+        writers = []
+        while not self._idle.empty():
+            _, writer, _ = self._idle.get_nowait()
+            writer.close()
+            writers.append(writer)
+        await asyncio.gather(*(w.wait_closed() for w in writers), return_exceptions=True)
+
+    @asynccontextmanager
+    async def connection(self) -> AsyncIterator[Stream]:
+        reader, writer = await self._get()
+        try:
+            yield reader, writer
+        except ConnectionError as exc:
+            # servidor recusou (BUSY) ou caiu no meio da operação
+            writer.close()
+            raise HTTPException(503, "Servidor de PDFs indisponível, tente novamente") from exc
+        except BaseException:
+            # estado do protocolo desconhecido: a conexão não volta ao pool
+            writer.close()
+            raise
+        try:
+            self._idle.put_nowait((reader, writer, time.monotonic()))
+        except asyncio.QueueFull:
+            writer.close()
+
+_pool = SocketPool(POOL_SIZE)
+
 # ---------- operações socket ----------
 
-def _upload_socket(pdf: bytes) -> str:
-    with socket.socket() as s:
-        s.connect((SOCKET_HOST, SOCKET_PORT))
-        _send(s, b"UPLOAD\n" + struct.pack("!Q", len(pdf)) + pdf)
-        return _recv_line(s)
-
-def _merge_socket(a: bytes, b: bytes) -> str:
-    with socket.socket() as s:
-        s.connect((SOCKET_HOST, SOCKET_PORT))
-        _send(s, b"MERGE\n")
-        _send(s, struct.pack("!Q", len(a)) + a)
-        _send(s, struct.pack("!Q", len(b)) + b)
-        return _recv_line(s)
-
-def _extract_socket(pdf: bytes, start: int, end: int) -> str:
-    with socket.socket() as s:
-        s.connect((SOCKET_HOST, SOCKET_PORT))
-        _send(s, f"EXTRACT {start}-{end}\n".encode())
-        _send(s, struct.pack("!Q", len(pdf)) + pdf)
-        resp = _recv_line(s)
-        if resp == "PAGEERR":
-            raise HTTPException(400, "PDF possui menos páginas que o range solicitado")
-        return resp
-
-def _download_socket(uuid_str: str) -> bytes:
-    with socket.socket() as s:
-        s.connect((SOCKET_HOST, SOCKET_PORT))
-        _send(s, f"DOWNLOAD {uuid_str}\n".encode())
-        status = _recv_line(s)
-        if status == "NOTFOUND":
-            raise FileNotFoundError()
-        if status != "FOUND":
-            raise RuntimeError(status)
-        size = struct.unpack("!Q", _recv_exact(s, 8))[0]
-        return _recv_exact(s, size)
+async def _upload_socket(pdf: UploadFile) -> str:
+    async with _pool.connection() as (reader, writer):
+        await _send_file(writer, pdf, b"UPLOAD\n")
+        return await _recv_line(reader)
+
+async def _merge_socket(a: UploadFile, b: UploadFile) -> str:
+    async with _pool.connection() as (reader, writer):
+        await _send_file(writer, a, b"MERGE\n")
+        await _send_file(writer, b)
+        return await _recv_line(reader)
+
+async def _extract_socket(pdf: UploadFile, start: int, end: int) -> str:
+    async with _pool.connection() as (reader, writer):
+        await _send_file(writer, pdf, f"EXTRACT {start}-{end}\n".encode())
+        resp = await _recv_line(reader)
+    if resp == "PAGEERR":
+        raise HTTPException(400, "PDF possui menos páginas que o range solicitado")
+    return resp
+
+async def _download_stream(uuid_str: str) -> AsyncIterator[Union[int, bytes]]:
+    """Gera o tamanho do PDF e, em seguida, seu conteúdo em blocos lidos do socket."""
+    async with _pool.connection() as (reader, writer):
+        await _send(writer, f"DOWNLOAD {uuid_str}\n".encode())
+        status = await _recv_line(reader)
+        if status == "FOUND":
+            remaining = struct.unpack("!Q", await _recv_exact(reader, 8))[0]
+            yield remaining
+            while remaining:
+                chunk = await reader.read(min(BUFFER_SIZE, remaining))
+                if not chunk:
+                    raise RuntimeError("Conexão encerrada")
+                remaining -= len(chunk)
+                yield chunk
+            return
+    if status == "NOTFOUND":
+        raise FileNotFoundError()
+    raise RuntimeError(status)
 
 # ---------- endpoints ----------
 
 @app.post("/upload")
 async def upload(file: UploadFile = File(...)):
     _validate_pdf(file, "file")
-    data = await file.read()
-    return {"uuid": _upload_socket(data)}
+    return {"uuid": await _upload_socket(file)}
 
 @app.post("/merge")
 async def merge(file1: UploadFile = File(...), file2: UploadFile = File(...)):
     for f, n in ((file1, "file1"), (file2, "file2")):
         _validate_pdf(f, n)
-    data1, data2 = await file1.read(), await file2.read()
-    return {"uuid": _merge_socket(data1, data2)}
+    return {"uuid": await _merge_socket(file1, file2)}
 
 @app.post("/extract")
 async def extract(range: str = Form(...), file: UploadFile = File(...)):
     _validate_pdf(file, "file")
     start, end = _parse_range(range)
-    data = await file.read()
-    return {"uuid": _extract_socket(data, start, end)}
+    return {"uuid": await _extract_socket(file, start, end)}
 
 @app.get("/download/{uuid_str}")
 async def download(uuid_str: str):
+    # o parâmetro vem percent-decoded e pode conter "\n": só um UUID de verdade
+    # vai para a linha de comando, que é escrita em uma conexão compartilhada
+    try:
+        uuid_str = str(uuid.UUID(uuid_str))
+    except ValueError:
+        raise HTTPException(404, "Arquivo não encontrado")
+    stream = _download_stream(uuid_str)
     try:
-        pdf = _download_socket(uuid_str)
+        # status e tamanho chegam antes da resposta começar, para que o 404
+        # e o Content-Length possam ser enviados ao cliente
+        size = await anext(stream)
     except FileNotFoundError:
         raise HTTPException(404, "Arquivo não encontrado")
-    headers = {"Content-Disposition": f"attachment; filename={uuid_str}.pdf"}
-    return StreamingResponse(iter([pdf]), media_type="application/pdf", headers=headers)
+    headers = {
+        "Content-Disposition": f"attachment; filename={uuid_str}.pdf",
+        "Content-Length": str(size),
+    }
+    return StreamingResponse(stream, media_type="application/pdf", headers=headers)
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("proxyServer:app", host="0.0.0.0", port=8080, reload=True)
+    # um processo por CPU, cada um com seu event loop (uvloop), parser HTTP
+    # (httptools) e pool de conexões com o servidor de PDFs; para
+    # desenvolvimento com auto-reload use: uvicorn proxyServer:app --reload
+    uvicorn.run(
+        "proxyServer:app",
+        host="0.0.0.0",
+        port=8080,
+        workers=os.cpu_count() or 1,
+        loop="uvloop",
+        http="httptools",
+        reload=False,
+        backlog=2048,
+    )